@@ -1,11 +1,15 @@
-from gpiozero import Button
-from signal import pause
+import gpiod
+from gpiod.line import Bias, Direction, Edge, Value
+from collections import namedtuple
+from datetime import timedelta
 import os
+import queue
 import sys
+import threading
 import time
-from wyze_sdk.errors import WyzeApiError
 from dotenv import load_dotenv
 import json
+import logging
 
 print("🔧 Starting button.py...")
 
@@ -13,8 +17,43 @@ print("🔧 Starting button.py...")
 load_dotenv()
 print("🔧 Environment loaded")
 
-# Import your existing modules
+# Per-press diagnostics are logged at DEBUG; set LOG_LEVEL=DEBUG in .env to see them
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(), format='%(message)s')
+log = logging.getLogger('button')
+
+GPIO_CHIP = "/dev/gpiochip0"
+BUTTON_PIN = 4
+CONFIRM_DELAY = 0.02  # Seconds to wait before re-reading the pin to confirm a press
+# Query the device's real state before every toggle; set VERIFY_STATE=0 to trust the
+# locally tracked state instead (saves a round-trip, but misses changes made elsewhere)
+VERIFY_STATE = os.getenv('VERIFY_STATE', '1') == '1'
+
+print("🔧 Initializing GPIO button...")
+try:
+    # Kernel-side edge detection: the process sleeps until the pin actually falls
+    button_request = gpiod.request_lines(
+        GPIO_CHIP,
+        consumer="wyze-button",
+        config={
+            BUTTON_PIN: gpiod.LineSettings(
+                direction=Direction.INPUT,
+                edge_detection=Edge.FALLING,
+                bias=Bias.PULL_UP,
+                debounce_period=timedelta(milliseconds=100)
+            )
+        }
+    )
+    print("✅ GPIO button initialized")
+except Exception as e:
+    print(f"❌ GPIO button error: {e}")
+    print("💡 Try running with: sudo .venv/bin/python button.py")
+    sys.exit(1)
+
+
+# Import your existing modules (after GPIO setup, so wiring/permission errors
+# fail fast without first paying for the Wyze SDK import)
 try:
+    from wyze_sdk.errors import WyzeApiError
     from token_manager import token_manager
     print("🔧 Token manager imported")
     from button_config import button_config
@@ -23,175 +62,204 @@ except Exception as e:
     print(f"❌ Import error: {e}")
     sys.exit(1)
 
-print("🔧 Initializing GPIO button...")
-try:
-    button = Button(4, bounce_time=0.1)
-    print("✅ GPIO button initialized")
-except Exception as e:
-    print(f"❌ GPIO button error: {e}")
-    print("💡 Try running with: sudo .venv/bin/python button.py")
-    sys.exit(1)
+
+# What a press needs to send a command; built from the saved config when it has the
+# model and type, otherwise from the device list
+ButtonTarget = namedtuple('ButtonTarget', ['mac', 'nickname', 'model', 'type'])
 
 
 class FlaskIntegratedButtonController:
     def __init__(self):
-        print("🔧 Initializing FlaskIntegratedButtonController...")
-        self.client = None
-        self.last_press_time = 0
-        self.debounce_delay = 1.0  # Prevent accidental double-presses
+        log.debug("🔧 Initializing FlaskIntegratedButtonController...")
+        self._devices_cache_ttl = 60  # Seconds before the device list is fetched again
+        self._state_by_mac = {}  # Last known on/off state, updated after each command
+        self._revalidate = False  # Set after a failed command to re-check the device list
+        # Presses are handed to a single worker so Wyze calls never block the GPIO loop
+        self._press_q = queue.Queue(maxsize=1)
+        self._cfg = None
+        self._cfg_mtime = 0
         self.initialize()
+        threading.Thread(target=self._worker, daemon=True).start()
 
     def initialize(self):
         """Initialize Wyze client"""
         try:
-            print("🚀 Initializing Wyze connection...")
-            self.client = token_manager.get_client()
-            print("✅ Wyze client initialized successfully!")
+            log.info("🚀 Initializing Wyze connection...")
+            token_manager.get_client()
+            log.info("✅ Wyze client initialized successfully!")
         except (WyzeApiError, EnvironmentError) as e:
-            print(f"❌ Failed to initialize Wyze client: {e}")
+            log.error(f"❌ Failed to initialize Wyze client: {e}")
             sys.exit(1)
 
-    def get_target_device(self):
-        """Get the currently configured button device from the config (fresh each time)"""
-        # Read JSON file directly to ensure fresh data
+    def _worker(self):
+        """Run queued button presses one at a time"""
+        while True:
+            self._press_q.get()
+            try:
+                self.toggle_device()
+            except Exception:
+                # Keep the only worker alive, or every later press would be dropped
+                log.exception("❌ Button press failed")
+
+    def handle_press(self):
+        """Queue a button press without blocking (presses during a pending one are coalesced)"""
+        try:
+            self._press_q.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def _load_cfg_if_stale(self):
+        """Return the parsed button config, re-reading the file only when its mtime changes"""
         try:
-            with open('button_config.json', 'r') as file:
-                config_data = json.load(file)
-            button_device_config = config_data.get('button_device')
+            st = os.stat(button_config.config_file)
+            if st.st_mtime_ns != self._cfg_mtime:
+                with open(button_config.config_file, 'r') as file:
+                    self._cfg = json.load(file)
+                self._cfg_mtime = st.st_mtime_ns
         except FileNotFoundError:
-            print("⚠️  button_config.json not found")
-            return None
+            log.warning(f"⚠️  {button_config.config_file} not found")
+            self._cfg, self._cfg_mtime = None, 0
         except json.JSONDecodeError:
-            print("⚠️  Invalid JSON in button_config.json")
+            log.warning(f"⚠️  Invalid JSON in {button_config.config_file}")
+            self._cfg, self._cfg_mtime = None, 0
+        return self._cfg
+
+    def get_target_device(self, verify=False):
+        """Get the currently configured button device (verify=True always checks the device list)"""
+        cfg = self._load_cfg_if_stale()
+        if cfg is None:
             return None
+        button_device_config = cfg.get('button_device')
 
         if not button_device_config:
-            print("⚠️  No device configured for button control")
-            print("   Use the Flask web interface to set a button device")
+            log.warning("⚠️  No device configured for button control")
+            log.warning("   Use the Flask web interface to set a button device")
             return None
 
+        # Saved model and type: send the command straight away, no device list needed
+        if not (verify or self._revalidate) and 'model' in button_device_config and 'type' in button_device_config:
+            return ButtonTarget(button_device_config['mac'], button_device_config['nickname'],
+                                button_device_config['model'], button_device_config['type'])
+
         try:
-            devices = self.client.devices_list()
-            device = next((d for d in devices if d.mac == button_device_config['mac']), None)
+            # After an error, list devices again rather than trusting the cached list
+            max_age = 0 if self._revalidate else self._devices_cache_ttl
+            device = token_manager.get_device(button_device_config['mac'], max_age=max_age)
 
             if not device:
-                print(f"❌ Configured device {button_device_config['nickname']} not found")
+                log.error(f"❌ Configured device {button_device_config['nickname']} not found")
                 return None
 
             if not device.is_online:
-                print(f"⚠️  Device {device.nickname} is offline")
+                log.warning(f"⚠️  Device {device.nickname} is offline")
                 return None
 
-            return device
+            self._revalidate = False
+            target = ButtonTarget(device.mac, device.nickname, device.product.model, device.type)
+            # Save what the device list says, so later presses don't reuse a stale model or type
+            if (button_device_config.get('model'), button_device_config.get('type')) != (target.model, target.type):
+                log.info(f"🔧 Updating saved model/type for {target.nickname}")
+                if not button_config.set_button_device(target.mac, target.nickname, target.model, target.type):
+                    log.warning(f"⚠️  Could not save {button_config.config_file}")
+            return target
 
         except WyzeApiError as e:
-            print(f"❌ Error getting device list: {e}")
+            log.error(f"❌ Error getting device list: {e}")
             return None
 
     def get_device_state(self, device):
         """Get the current state of the device"""
         try:
-            print(f"🔍 Checking current state of {device.nickname}...")
+            log.debug("🔍 Checking current state of %s...", device.nickname)
 
             # Different device types have different state properties
-            if device.type == 'Plug':
-                # For plugs, get detailed info including state
-                plug_info = self.client.plugs.info(device_mac=device.mac)
-                is_on = plug_info.is_on
-            elif device.type in ['MeshLight', 'Bulb', 'Light']:
-                # For bulbs, get detailed info including state
-                bulb_info = self.client.bulbs.info(device_mac=device.mac)
-                is_on = bulb_info.is_on
-            else:
-                print(f"⚠️  Unknown device type {device.type}, assuming OFF")
+            if token_manager.controller_for(device.type) is None:
+                log.warning(f"⚠️  Unknown device type {device.type}, assuming OFF")
                 return False
+            # Through token_manager.call so a rejected token is refreshed and the query retried
+            is_on = token_manager.call(
+                lambda client: token_manager.controller_for(device.type).info(device_mac=device.mac)
+            ).is_on
 
-            state_text = "ON" if is_on else "OFF"
-            print(f"💡 {device.nickname} is currently {state_text}")
+            log.debug("💡 %s is currently %s", device.nickname, "ON" if is_on else "OFF")
             return is_on
 
         except WyzeApiError as e:
-            print(f"❌ Error getting device state: {e}")
-            print("🔄 Assuming device is OFF for toggle logic")
+            log.error(f"❌ Error getting device state: {e}")
+            log.warning("🔄 Assuming device is OFF for toggle logic")
             return False
 
     def toggle_device(self):
         """Toggle the configured button device based on its current state"""
-        current_time = time.time()
-        if current_time - self.last_press_time < self.debounce_delay:
-            print("⏱️  Button press ignored (debounce)")
-            return
-
-        self.last_press_time = current_time
-
         # Get current target device from configuration (fresh each time)
-        print("🔧 Checking for updated device configuration...")
-        device = self.get_target_device()
-        if not device:
-            return
-
+        log.debug("🔧 Checking for updated device configuration...")
+        device = None
         try:
-            # Get the actual current state of the device
-            current_state = self.get_device_state(device)
+            device = self.get_target_device()
+            if not device:
+                return
+
+            # Use the state we last set unless verifying; always query on a cold start or after an error
+            current_state = None if VERIFY_STATE else self._state_by_mac.get(device.mac)
+            if current_state is None:
+                current_state = self.get_device_state(device)
+                self._state_by_mac[device.mac] = current_state
 
             # Toggle to opposite state
             action = "off" if current_state else "on"
-            print(f"🔄 Turning {action.upper()} {device.nickname}...")
+            log.debug("🔄 Turning %s %s...", action.upper(), device.nickname)
 
             # Determine controller type
-            device_controllers = {
-                'Plug': self.client.plugs,
-                'MeshLight': self.client.bulbs,
-                'Bulb': self.client.bulbs,
-                'Light': self.client.bulbs
-            }
-
-            controller = device_controllers.get(device.type)
-            if not controller:
-                print(f"❌ Unsupported device type: {device.type}")
+            if token_manager.controller_for(device.type) is None:
+                log.error(f"❌ Unsupported device type: {device.type}")
                 return
 
-            # Execute command
-            if action == "on":
-                controller.turn_on(
-                    device_mac=device.mac,
-                    device_model=device.product.model
-                )
-            else:
-                controller.turn_off(
-                    device_mac=device.mac,
-                    device_model=device.product.model
-                )
+            def send_command(client):
+                # Looked up inside the call so a retry uses the refreshed client's controller
+                controller = token_manager.controller_for(device.type)
+                if action == "on":
+                    controller.turn_on(device_mac=device.mac, device_model=device.model)
+                else:
+                    controller.turn_off(device_mac=device.mac, device_model=device.model)
+
+            # Execute command, refreshing the token and retrying once if Wyze rejects it
+            token_manager.call(send_command)
 
             # Show success message
             new_state = not current_state
+            self._state_by_mac[device.mac] = new_state
             status_emoji = "💡" if new_state else "🌙"
-            print(f"✅ {status_emoji} {device.nickname} is now {action.upper()}")
+            log.info(f"✅ {status_emoji} {device.nickname} is now {action.upper()}")
 
         except WyzeApiError as e:
-            print(f"❌ Error controlling device: {e}")
+            log.error(f"❌ Error controlling device: {e}")
+            # Force a fresh device list and state query on the next press, in case
+            # the device went offline or its model changed since it was saved
+            self._revalidate = True
+            if device:
+                self._state_by_mac.pop(device.mac, None)
         except Exception as e:
-            print(f"❌ Unexpected error: {e}")
+            log.error(f"❌ Unexpected error: {e}")
 
     def show_status(self):
         """Show current button configuration status"""
         button_device_config = button_config.get_button_device()
         if button_device_config:
-            print(f"🎯 Button configured for: {button_device_config['nickname']}")
-            print(f"📍 MAC: {button_device_config['mac']}")
+            log.info(f"🎯 Button configured for: {button_device_config['nickname']}")
+            log.info(f"📍 MAC: {button_device_config['mac']}")
 
-            device = self.get_target_device()
+            device = self.get_target_device(verify=True)
             if device:
-                print(f"✅ Device is online and ready")
+                log.info(f"✅ Device is online and ready")
                 # Show current state
                 current_state = self.get_device_state(device)
                 state_text = "ON" if current_state else "OFF"
-                print(f"💡 Current state: {state_text}")
+                log.info(f"💡 Current state: {state_text}")
             else:
-                print("⚠️  Device is not available")
+                log.warning("⚠️  Device is not available")
         else:
-            print("⚠️  No device configured for button control")
-            print("   Visit the Flask web interface to configure a device")
+            log.warning("⚠️  No device configured for button control")
+            log.warning("   Visit the Flask web interface to configure a device")
 
 
 print("🔧 Creating controller instance...")
@@ -212,15 +280,6 @@ except Exception as e:
     print(f"❌ Error showing status: {e}")
 print("=" * 50)
 
-# Set up button handler
-print("🔧 Setting up button handler...")
-try:
-    button.when_pressed = controller.toggle_device
-    print("✅ Button handler set")
-except Exception as e:
-    print(f"❌ Button handler error: {e}")
-    sys.exit(1)
-
 print("🔘 Press the button to toggle your configured device")
 print("🌐 Visit the Flask app to change button configuration")
 print("⌨️  Press Ctrl+C to exit")
@@ -228,8 +287,17 @@ print("\n📋 Button will check configuration and device state on each press")
 
 try:
     print("🔧 Starting main loop...")
-    pause()
+    while True:
+        # Blocks in epoll until the kernel reports an edge on the button line
+        button_request.wait_edge_events()
+        button_request.read_edge_events()
+        # Two-sample debounce: only count the edge if the line is still held low shortly after
+        time.sleep(CONFIRM_DELAY)
+        if button_request.get_value(BUTTON_PIN) == Value.INACTIVE:
+            controller.handle_press()
 except KeyboardInterrupt:
     print("\n👋 Shutting down...")
 except Exception as e:
-    print(f"❌ Main loop error: {e}")
\ No newline at end of file
+    print(f"❌ Main loop error: {e}")
+finally:
+    button_request.release()
\ No newline at end of file
@@ -39,7 +39,8 @@ class ButtonConfig:
         """Get the currently configured button device"""
         return self.config_data.get("button_device")
 
-    def set_button_device(self, mac: str, nickname: str) -> bool:
+    def set_button_device(self, mac: str, nickname: str, model: Optional[str] = None,
+                          device_type: Optional[str] = None) -> bool:
         """Set which device the button should control"""
         import datetime
 
@@ -47,6 +48,9 @@ class ButtonConfig:
             "mac": mac,
             "nickname": nickname
         }
+        # Model and type let the button send commands without listing devices first
+        if model and device_type:
+            self.config_data["button_device"].update(model=model, type=device_type)
         self.config_data["last_updated"] = datetime.datetime.now().isoformat()
 
         return self._save_config()
@@ -4,20 +4,25 @@ Console application for controlling Wyze devices via menu interface.
 Perfect for Raspberry Pi deployment with GPIO button integration.
 """
 
-import os
 import sys
-from typing import List, Optional
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
 from wyze_sdk.errors import WyzeApiError
 from wyze_sdk.models.devices import Device
 
 # Import our existing token manager
-from token_manager import token_manager
+from token_manager import token_manager, MISSING_ENV_VARS
 
 
 class WyzeConsoleController:
     def __init__(self):
         self.client = None
         self.devices = []
+        self._by_mac = {}
+        self._by_nick = {}
+        self._devices_cache_ts = None
+        self._devices_cache_ttl = 60  # Seconds before the device list is fetched again
 
     def initialize(self) -> bool:
         """Initialize the Wyze client and load devices"""
@@ -25,16 +30,32 @@ class WyzeConsoleController:
             print("Initializing Wyze connection...")
             self.client = token_manager.get_client()
             self.refresh_devices()
+            if self._devices_cache_ts is None:
+                return False
             print(f"Successfully connected! Found {len(self.devices)} devices.")
             return True
         except (WyzeApiError, EnvironmentError) as e:
             print(f"Failed to initialize: {e}")
             return False
 
-    def refresh_devices(self) -> None:
-        """Refresh the device list"""
-        if self.client:
-            self.devices = [d for d in self.client.devices_list() if d.is_online]
+    def refresh_devices(self, force: bool = False) -> None:
+        """Refresh the device list (served from cache until the TTL expires unless forced)"""
+        if not self.client:
+            return
+        if (not force and self._devices_cache_ts is not None and
+                time.monotonic() - self._devices_cache_ts < self._devices_cache_ttl):
+            return
+        try:
+            all_devices = token_manager.call(lambda client: client.devices_list())
+        except WyzeApiError as e:
+            # Keep serving the last list rather than dropping out of the menu
+            print(f"Error refreshing devices: {e}")
+            return
+        # Index every device so offline ones still resolve; the menu list stays online-only
+        self._by_mac = {d.mac: d for d in all_devices}
+        self._by_nick = {d.nickname.lower(): d for d in all_devices}
+        self.devices = [d for d in all_devices if d.is_online]
+        self._devices_cache_ts = time.monotonic()
 
     def display_devices(self) -> None:
         """Display all available devices"""
@@ -49,31 +70,66 @@ class WyzeConsoleController:
 
     def toggle_device(self, device: Device, action: str) -> bool:
         """Toggle a device on or off"""
-        try:
-            print(f"Turning {action} {device.nickname}...")
+        if token_manager.controller_for(device.type) is None:
+            print(f"Unsupported device type: {device.type}")
+            return False
+
+        def send_command(client):
+            controller = token_manager.controller_for(device.type)
             if action == "on":
-                self.client.plugs.turn_on(device_mac=device.mac, device_model=device.product.model)
+                controller.turn_on(device_mac=device.mac, device_model=device.product.model)
             elif action == "off":
-                self.client.plugs.turn_off(device_mac=device.mac, device_model=device.product.model)
+                controller.turn_off(device_mac=device.mac, device_model=device.product.model)
+
+        try:
+            print(f"Turning {action} {device.nickname}...")
+            # Refreshes the token and retries once if Wyze rejects it
+            token_manager.call(send_command)
             print(f"Successfully turned {action} {device.nickname}")
             return True
         except WyzeApiError as e:
             print(f"Error controlling {device.nickname}: {e}")
+            # Force a fresh device list on the next refresh
+            self._devices_cache_ts = None
             return False
 
+    def get_device_state(self, device: Device) -> Optional[bool]:
+        """Get whether a device is on (None if the type is unsupported or the query fails)"""
+        if token_manager.controller_for(device.type) is None:
+            return None
+        try:
+            return token_manager.call(
+                lambda client: token_manager.controller_for(device.type).info(device_mac=device.mac)
+            ).is_on
+        except WyzeApiError as e:
+            print(f"Error getting state of {device.nickname}: {e}")
+            return None
+
+    def bulk_states(self, devices: List[Device]) -> Dict[str, Optional[bool]]:
+        """Query the state of several devices concurrently, keyed by MAC address"""
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            return dict(zip([d.mac for d in devices], executor.map(self.get_device_state, devices)))
+
+    def display_states(self) -> None:
+        """Display the on/off state of all online devices"""
+        if not self.devices:
+            print("No online devices found.")
+            return
+
+        states = self.bulk_states(self.devices)
+        print("\n=== Device States ===")
+        for device in self.devices:
+            state = states[device.mac]
+            state_text = "Unknown" if state is None else ("ON" if state else "OFF")
+            print(f"{device.nickname} ({device.mac}) - {state_text}")
+
     def get_device_by_nickname(self, nickname: str) -> Optional[Device]:
         """Find device by nickname (case-insensitive)"""
-        for device in self.devices:
-            if device.nickname.lower() == nickname.lower():
-                return device
-        return None
+        return self._by_nick.get(nickname.lower())
 
     def get_device_by_mac(self, mac: str) -> Optional[Device]:
         """Find device by MAC address"""
-        for device in self.devices:
-            if device.mac == mac:
-                return device
-        return None
+        return self._by_mac.get(mac)
 
 
 def show_main_menu():
@@ -87,6 +143,7 @@ def show_main_menu():
     print("4. Toggle specific device (by nickname)")
     print("5. Refresh device list")
     print("6. Quick toggle (by MAC address)")
+    print("7. Show device states")
     print("q. Quit")
     print("=" * 50)
 
@@ -98,6 +155,7 @@ def get_user_choice() -> str:
 
 def select_device(controller: WyzeConsoleController) -> Optional[Device]:
     """Let user select a device from the list"""
+    controller.refresh_devices()
     if not controller.devices:
         print("No devices available.")
         return None
@@ -118,11 +176,15 @@ def select_device(controller: WyzeConsoleController) -> Optional[Device]:
 def quick_toggle_by_name(controller: WyzeConsoleController) -> None:
     """Quick toggle by device nickname"""
     nickname = input("Enter device nickname: ").strip()
+    controller.refresh_devices()
     device = controller.get_device_by_nickname(nickname)
 
     if not device:
         print(f"Device '{nickname}' not found.")
         return
+    if not device.is_online:
+        print(f"Device '{device.nickname}' is offline.")
+        return
 
     action = input(f"Turn {device.nickname} [on/off]: ").strip().lower()
     if action in ['on', 'off']:
@@ -134,11 +196,15 @@ def quick_toggle_by_name(controller: WyzeConsoleController) -> None:
 def quick_toggle_by_mac(controller: WyzeConsoleController) -> None:
     """Quick toggle by MAC address (useful for GPIO scripting)"""
     mac = input("Enter device MAC address: ").strip()
+    controller.refresh_devices()
     device = controller.get_device_by_mac(mac)
 
     if not device:
         print(f"Device with MAC '{mac}' not found.")
         return
+    if not device.is_online:
+        print(f"Device '{device.nickname}' is offline.")
+        return
 
     action = input(f"Turn {device.nickname} [on/off]: ").strip().lower()
     if action in ['on', 'off']:
@@ -167,6 +233,9 @@ def gpio_toggle_device(mac_address: str, action: str) -> bool:
     if not device:
         print(f"Device with MAC {mac_address} not found.")
         return False
+    if not device.is_online:
+        print(f"Device {device.nickname} is offline.")
+        return False
 
     return controller.toggle_device(device, action)
 
@@ -176,10 +245,8 @@ def main():
     print("Starting Wyze Console Controller...")
 
     # Validate environment variables
-    required_vars = ['WYZE_EMAIL', 'WYZE_PASSWORD', 'WYZE_KEY_ID', 'WYZE_API_KEY']
-    missing_vars = [var for var in required_vars if not os.getenv(var)]
-    if missing_vars:
-        print(f"Error: Missing environment variables: {', '.join(missing_vars)}")
+    if MISSING_ENV_VARS:
+        print(f"Error: Missing environment variables: {', '.join(MISSING_ENV_VARS)}")
         print("Please check your .env file.")
         sys.exit(1)
 
@@ -195,6 +262,7 @@ def main():
         choice = get_user_choice()
 
         if choice == '1':
+            controller.refresh_devices()
             controller.display_devices()
 
         elif choice == '2':
@@ -212,12 +280,16 @@ def main():
 
         elif choice == '5':
             print("Refreshing device list...")
-            controller.refresh_devices()
+            controller.refresh_devices(force=True)
             print(f"Found {len(controller.devices)} online devices.")
 
         elif choice == '6':
             quick_toggle_by_mac(controller)
 
+        elif choice == '7':
+            controller.refresh_devices()
+            controller.display_states()
+
         elif choice == 'q':
             print("Goodbye!")
             break
@@ -0,0 +1,110 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from unittest import mock
+
+import token_manager as tm
+from wyze_sdk.errors import WyzeApiError
+
+
+class SavedTokenTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.token_file = Path(self.tmpdir.name) / 'tokens.json'
+        patcher = mock.patch.object(tm, '_TOKEN_FILE', self.token_file)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_tokens(self, expires_in):
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=expires_in)
+        self.token_file.write_text(json.dumps({
+            'access_token': 'old-access',
+            'refresh_token': 'old-refresh',
+            'expires_at': expires_at.isoformat()
+        }))
+
+    def test_expired_saved_token_is_refreshed(self):
+        self.write_tokens(expires_in=-60)
+        with mock.patch.object(tm, 'Client') as client_cls:
+            client_cls.return_value.refresh_token.return_value = {
+                'data': {'access_token': 'new-access', 'refresh_token': 'new-refresh'}
+            }
+            manager = tm.TokenManager()
+            self.assertTrue(manager.is_token_expired())
+            manager.get_client()
+
+        client_cls.assert_any_call(token='old-access', refresh_token='old-refresh')
+        client_cls.return_value.refresh_token.assert_called_once_with()
+        client_cls.return_value.login.assert_not_called()
+        self.assertEqual(manager.access_token, 'new-access')
+        self.assertFalse(manager.is_token_expired())
+
+        saved = json.loads(self.token_file.read_text())
+        self.assertEqual(saved['refresh_token'], 'new-refresh')
+        self.assertEqual(os.stat(self.token_file).st_mode & 0o777, 0o600)
+
+    def test_failed_refresh_falls_back_to_login(self):
+        self.write_tokens(expires_in=-60)
+        with mock.patch.object(tm, 'Client') as client_cls:
+            client_cls.return_value.refresh_token.side_effect = TypeError('bad response')
+            client_cls.return_value.login.return_value = {
+                'access_token': 'login-access', 'refresh_token': 'login-refresh'
+            }
+            manager = tm.TokenManager()
+            manager.get_client()
+
+        client_cls.return_value.login.assert_called_once()
+        self.assertEqual(manager.access_token, 'login-access')
+
+    def test_valid_saved_token_is_reused(self):
+        self.write_tokens(expires_in=3600)
+        with mock.patch.object(tm, 'Client') as client_cls:
+            manager = tm.TokenManager()
+            manager.get_client()
+
+        client_cls.return_value.refresh_token.assert_not_called()
+        client_cls.return_value.login.assert_not_called()
+        self.assertEqual(manager.access_token, 'old-access')
+        self.assertGreater(manager.expires_at - time.monotonic(), 3000)
+
+
+class CallRetryTests(unittest.TestCase):
+    def test_rejected_token_is_refreshed_and_retried(self):
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.object(tm, '_TOKEN_FILE', Path(tmpdir) / 'tokens.json'), \
+                mock.patch.object(tm, 'Client') as client_cls:
+            client_cls.return_value.refresh_token.return_value = {
+                'data': {'access_token': 'new-access', 'refresh_token': 'new-refresh'}
+            }
+            manager = tm.TokenManager()
+            manager._update_tokens_and_client({'access_token': 'old-access', 'refresh_token': 'old-refresh'})
+
+            tokens_seen = []
+
+            def fn(client):
+                tokens_seen.append(manager.access_token)
+                if len(tokens_seen) == 1:
+                    raise WyzeApiError('The access token has expired.', {'code': 2001, 'msg': 'AccessTokenError'})
+                return 'ok'
+
+            self.assertEqual(manager.call(fn), 'ok')
+
+        self.assertEqual(tokens_seen, ['old-access', 'new-access'])
+        client_cls.return_value.login.assert_not_called()
+
+    def test_other_errors_are_not_retried(self):
+        manager = tm.TokenManager()
+        manager.get_client = mock.Mock()
+        fn = mock.Mock(side_effect=WyzeApiError('Unknown request error', {'code': 1003}))
+        with self.assertRaises(WyzeApiError):
+            manager.call(fn)
+        fn.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,25 +1,104 @@
 import os
-from datetime import datetime, timedelta
-from typing import Mapping
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from http.cookiejar import DefaultCookiePolicy
+from json import dumps, loads
+from pathlib import Path
+from typing import Callable, Dict, List, Mapping, Optional, Tuple, TypeVar
 # Import the load_dotenv function
 from dotenv import load_dotenv
+from markupsafe import escape
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from wyze_sdk import Client
 from wyze_sdk.errors import WyzeApiError
+from wyze_sdk.models.devices import Device
+from wyze_sdk.service.base import BaseServiceClient
 
 # Load environment variables from the .env file
 load_dotenv()
 
+T = TypeVar('T')
+
+REQUIRED_ENV_VARS = ('WYZE_EMAIL', 'WYZE_PASSWORD', 'WYZE_KEY_ID', 'WYZE_API_KEY')
+# Read once at import time; the environment doesn't change while the process runs
+WYZE_CREDENTIALS = {var: os.environ.get(var) for var in REQUIRED_ENV_VARS}
+MISSING_ENV_VARS = [var for var, value in WYZE_CREDENTIALS.items() if not value]
+
+# Seconds a fetched device list is reused before asking Wyze again
+DEVICES_CACHE_TTL = 30
+# Refresh the access token this many seconds before it actually expires
+TOKEN_REFRESH_MARGIN = 5 * 60
+# Tokens are saved here so a restart can reuse or refresh them instead of logging in again
+_TOKEN_FILE = Path(os.getenv('WYZE_TOKEN_FILE', '~/.cache/wyze/tokens.json')).expanduser()
+
+# One pooled HTTP session shared by every Wyze API call, so repeated calls reuse the
+# same TLS connection instead of handshaking with api.wyzecam.com each time
+_http_session = requests.Session()
+_http_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10,
+                            max_retries=Retry(total=2, backoff_factor=0.2))
+_http_session.mount('https://', _http_adapter)
+_http_session.mount('http://', _http_adapter)
+_http_session.headers['Connection'] = 'keep-alive'
+# The SDK's per-call sessions never carried cookies from one call to the next; keep it that way
+_http_session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+
+def _pooled_do_post(self, url, headers, payload, params=None, method='POST'):
+    """BaseServiceClient.do_post, sending through the shared session"""
+    # Headers go on the request, not the session, so they don't leak between calls
+    req = _http_session.prepare_request(
+        requests.Request(method, url, headers=headers, json=payload, params=params))
+    # The server expects compact JSON with no extra whitespace
+    if isinstance(payload, dict):
+        payload = dumps(payload, separators=(',', ':'))
+    if isinstance(payload, str):
+        req.body = payload.encode('utf-8')
+        req.prepare_content_length(req.body)
+    return self._do_request(_http_session, req)
+
+
+def _pooled_do_get(self, url, headers, payload):
+    """BaseServiceClient.do_get, sending through the shared session"""
+    req = _http_session.prepare_request(
+        requests.Request('GET', url, headers=headers, params=payload))
+    return self._do_request(_http_session, req)
+
+
+# wyze_sdk opens a new requests.Session for every call and has no transport hook
+BaseServiceClient.do_post = _pooled_do_post
+BaseServiceClient.do_get = _pooled_do_get
+
+# Error code Wyze returns when the access token has expired or been revoked
+ACCESS_TOKEN_ERROR_CODE = '2001'
+
 class TokenManager:
     def __init__(self):
         self.access_token = None
         self.refresh_token = None
         self.expires_at = None
         self.client = None
-        # Now, these will be correctly populated after load_dotenv() runs
-        self._email = os.environ.get('WYZE_EMAIL')
-        self._password = os.environ.get('WYZE_PASSWORD')
-        self._key_id = os.environ.get('WYZE_KEY_ID')
-        self._api_key = os.environ.get('WYZE_API_KEY')
+        # Guards token state so a refresh is never observed half-applied
+        self._lock = threading.RLock()
+        self._refresher = None
+        self._devices_cache = {"ts": 0, "data": None}
+        self._devices_by_mac = {}
+        self._devices_view = []
+        self._views_by_mac = {}
+        self._online_view = []
+        self._offline_view = []
+        self._controllers = {}
+        # Wyze commands are network-bound, so several can be in flight at once
+        self._executor = ThreadPoolExecutor(max_workers=8)
+        self._email = WYZE_CREDENTIALS['WYZE_EMAIL']
+        self._password = WYZE_CREDENTIALS['WYZE_PASSWORD']
+        self._key_id = WYZE_CREDENTIALS['WYZE_KEY_ID']
+        self._api_key = WYZE_CREDENTIALS['WYZE_API_KEY']
+        self._load_tokens()
 
     def _login(self):
         """Performs full login to get new tokens"""
@@ -40,11 +119,11 @@ class TokenManager:
         """Refreshes the access token using the refresh token"""
         print("Refreshing the access token...")
         try:
-            temp_client = Client(token=self.access_token)
-            # Corrected this call to pass the refresh token
-            refresh_response = temp_client.refresh_token(self.refresh_token)
-            self._update_tokens_and_client(refresh_response)
-        except WyzeApiError as e:
+            temp_client = Client(token=self.access_token, refresh_token=self.refresh_token)
+            refresh_response = temp_client.refresh_token()
+            self._update_tokens_and_client(refresh_response['data'])
+        except Exception as e:
+            # Any failure (revoked refresh token, bad response, network) falls back to a full login
             print(f"Token refresh failed: {e}")
             self._login()
 
@@ -53,28 +132,221 @@ class TokenManager:
         self.access_token = token_data['access_token']
         self.refresh_token = token_data['refresh_token']
         expires_in = token_data.get('expires_in', 3600)
-        self.expires_at = datetime.now() + timedelta(seconds=expires_in)
-        self.client = Client(token=self.access_token)
+        # Monotonic so a wall-clock jump (e.g. NTP sync after boot) can't skew the expiry
+        self.expires_at = time.monotonic() + expires_in
+        self._set_client()
+        self._save_tokens()
         print("Tokens updated successfully.")
 
+    def _set_client(self):
+        """Builds a client for the current access token"""
+        self.client = Client(token=self.access_token)
+        # Resolve the per-type SDK sub-clients once per client instead of on every command
+        self._controllers = {
+            'Plug': self.client.plugs,
+            'MeshLight': self.client.bulbs,
+            'Bulb': self.client.bulbs,
+            'Light': self.client.bulbs
+        }
+        # The device list was fetched with the old token; fetch it again with the new one
+        self._devices_cache["data"] = None
+
+    def _save_tokens(self):
+        """Writes the tokens to the token file, readable only by this user"""
+        # The file outlives the process, so store the expiry as wall-clock time
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.expires_at - time.monotonic())
+        data = {
+            'access_token': self.access_token,
+            'refresh_token': self.refresh_token,
+            'expires_at': expires_at.isoformat()
+        }
+        try:
+            _TOKEN_FILE.parent.mkdir(parents=True, exist_ok=True)
+            # main.py and button.py share the file, so write a temp file and swap it in;
+            # mkstemp creates it 0600, so the tokens are never briefly world-readable
+            fd, tmp_path = tempfile.mkstemp(dir=_TOKEN_FILE.parent, prefix='.tokens-')
+            try:
+                with os.fdopen(fd, 'w') as file:
+                    file.write(dumps(data))
+                os.replace(tmp_path, _TOKEN_FILE)
+            except OSError:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            print(f"Could not save tokens to {_TOKEN_FILE}: {e}")
+
+    def _load_tokens(self):
+        """Restores tokens saved by a previous run, if any"""
+        try:
+            data = loads(_TOKEN_FILE.read_text())
+            access_token, refresh_token = data['access_token'], data['refresh_token']
+            remaining = (datetime.fromisoformat(data['expires_at']) - datetime.now(timezone.utc)).total_seconds()
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Ignoring unreadable token file {_TOKEN_FILE}: {e}")
+            return
+
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        # An already-expired token is still worth loading: get_client() refreshes it
+        self.expires_at = time.monotonic() + remaining
+        self._set_client()
+        print(f"Loaded saved tokens from {_TOKEN_FILE}.")
+
     def is_token_expired(self) -> bool:
         """Checks if the access token is missing or expired (with a 5-min buffer)"""
         if not self.access_token or not self.expires_at:
             return True
-        return datetime.now() >= self.expires_at - timedelta(minutes=5)
+        return time.monotonic() >= self.expires_at - TOKEN_REFRESH_MARGIN
 
-    def get_client(self) -> Client:
+    def invalidate(self):
+        """Marks the access token as expired so the next get_client() refreshes it"""
+        with self._lock:
+            self.expires_at = None
+
+    @staticmethod
+    def is_access_token_error(error: WyzeApiError) -> bool:
+        """Checks if a Wyze API error was caused by an expired or rejected access token"""
+        # wyze_sdk passes the raw response body as error.response
+        data = getattr(error, 'response', None)
+        if isinstance(data, Mapping):
+            code = data.get('code', data.get('errorCode'))
+            if str(code) == ACCESS_TOKEN_ERROR_CODE or data.get('msg') == 'AccessTokenError':
+                return True
+        # Fallback for errors raised without a response body
+        return 'access token' in str(error).lower()
+
+    def call(self, fn: Callable[[Client], T], verbose: bool = True) -> T:
+        """Runs fn with a valid client, refreshing and retrying once if Wyze rejects the token"""
+        try:
+            return fn(self.get_client(verbose))
+        except WyzeApiError as e:
+            if not self.is_access_token_error(e):
+                raise
+            print("Access token was rejected. Refreshing and retrying...")
+            self.invalidate()
+            return fn(self.get_client(verbose))
+
+    def get_devices(self, max_age: float = DEVICES_CACHE_TTL, verbose: bool = True) -> list:
+        """Returns the account's devices, reusing the last list for up to max_age seconds"""
+        if (self._devices_cache["data"] is None or
+                time.monotonic() - self._devices_cache["ts"] >= max_age):
+            devices = self.call(lambda client: client.devices_list(), verbose)
+            self._devices_by_mac = {d.mac: d for d in devices}
+            self._devices_view = [self._device_view(d) for d in devices]
+            self._views_by_mac = {view['mac']: view for view in self._devices_view}
+            self._online_view = [view for view in self._devices_view if view['online']]
+            self._offline_view = [view for view in self._devices_view if not view['online']]
+            self._devices_cache["data"] = devices
+            self._devices_cache["ts"] = time.monotonic()
+        return self._devices_cache["data"]
+
+    @staticmethod
+    def _device_view(device: Device) -> dict:
+        """Flattens a device into the fields pages show, HTML-escaped once up front"""
+        return {
+            'mac': escape(device.mac),
+            'nickname': escape(device.nickname),
+            'model': escape(device.product.model),
+            'type': escape(device.type),
+            'online': device.is_online
+        }
+
+    def get_devices_by_status(self, max_age: float = DEVICES_CACHE_TTL) -> Tuple[List[dict], List[dict]]:
+        """Returns the pre-escaped device views split into (online, offline)"""
+        self.get_devices(max_age)
+        return self._online_view, self._offline_view
+
+    def get_device_view(self, mac: str, max_age: float = DEVICES_CACHE_TTL) -> Optional[dict]:
+        """Returns the pre-escaped view of one device, or None if the account has none"""
+        self.get_devices(max_age)
+        return self._views_by_mac.get(mac)
+
+    def get_device(self, mac: str, max_age: float = DEVICES_CACHE_TTL) -> Optional[Device]:
+        """Returns the device with the given MAC address, or None if the account has none"""
+        self.get_devices(max_age)
+        return self._devices_by_mac.get(mac)
+
+    def controller_for(self, device_type: str):
+        """Returns the SDK sub-client (plugs/bulbs) that controls a device type, or None"""
+        return self._controllers.get(device_type)
+
+    def _send_command(self, mac: str, action: str) -> bool:
+        """Turns one device on or off, returning False if it can't be controlled"""
+        device = self.get_device(mac)
+        controller = self.controller_for(device.type) if device else None
+        if controller is None:
+            print(f"Cannot control device {mac}: not found or unsupported type")
+            return False
+        command = controller.turn_on if action == "on" else controller.turn_off
+        command(device_mac=device.mac, device_model=device.product.model)
+        return True
+
+    def toggle_many(self, mac_actions: List[Tuple[str, str]], timeout: float = 30) -> Dict[str, bool]:
+        """Sends on/off commands to several devices concurrently; returns success per MAC
+
+        Not used by the app yet; kept as the entry point for group/scene controls.
+        If a MAC appears more than once, only its last action is sent.
+        """
+        # Make sure the token and device list are fresh before fanning out
+        self.get_devices()
+        futures = {mac: self._executor.submit(self._send_command, mac, action)
+                   for mac, action in dict(mac_actions).items()}
+        done, _ = wait(futures.values(), timeout=timeout)
+
+        results = {}
+        for mac, future in futures.items():
+            if future not in done:
+                print(f"Timed out controlling device {mac}")
+                results[mac] = False
+                continue
+            try:
+                results[mac] = future.result()
+            except Exception as e:
+                # One device failing (API or network error) must not lose the others' results
+                print(f"Error controlling device {mac}: {e}")
+                results[mac] = False
+        return results
+
+    def get_client(self, verbose: bool = True) -> Client:
         """The main method to get a valid and authenticated client."""
-        if self.is_token_expired():
-            print(f"Access token is expired. Refreshing...")
-            if self.refresh_token:
-                print(f"Refresh token found. Authenticating with refresh token...")
-                self._refresh()
-            else:
-                print(f"No refresh token found. Performing full login...")
-                self._login()
-        print(f"Access token is valid. Returning client instance.")
-        return self.client
+        with self._lock:
+            if self.is_token_expired():
+                print(f"Access token is expired. Refreshing...")
+                if self.refresh_token:
+                    print(f"Refresh token found. Authenticating with refresh token...")
+                    self._refresh()
+                else:
+                    print(f"No refresh token found. Performing full login...")
+                    self._login()
+            if verbose:
+                print("Access token is valid. Returning client instance.")
+            return self.client
+
+    def _refresher_loop(self):
+        """Keeps the token and device list warm so requests never wait on a refresh"""
+        while True:
+            try:
+                # Quiet, or the journal gets a "token is valid" line every 30 seconds
+                self.get_client(verbose=False)
+                self.get_devices(max_age=0, verbose=False)
+            except Exception as e:
+                # Keep the thread alive; requests will surface the error themselves
+                print(f"Background refresh failed: {e}")
+                time.sleep(60)
+                continue
+            # expires_at can be cleared by invalidate() meanwhile; then refresh right away
+            expires_at = self.expires_at or time.monotonic()
+            refresh_in = expires_at - time.monotonic() - TOKEN_REFRESH_MARGIN
+            time.sleep(max(1, min(DEVICES_CACHE_TTL, refresh_in)))
+
+    def start_background_refresh(self):
+        """Starts a daemon thread that refreshes the token and device list ahead of requests"""
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresher_loop, daemon=True)
+            self._refresher.start()
+
 
 # Single, global instance for the app to use
 token_manager = TokenManager()
@@ -0,0 +1,19 @@
+"""
+Production entry point for the Flask app, served by gevent.
+
+Each request runs in a greenlet, so while one view is waiting on the Wyze API
+the others keep being served. Views stay plain sync functions; the patched
+sockets yield during the Wyze HTTPS calls.
+"""
+from gevent import monkey
+
+# Must run before anything else imports socket/ssl/threading
+monkey.patch_all()
+
+from gevent.pywsgi import WSGIServer
+
+from main import app
+
+if __name__ == "__main__":
+    print("Serving Wyze Flask app on http://0.0.0.0:5000 ...")
+    WSGIServer(('0.0.0.0', 5000), app).serve_forever()